@@ -1,4 +1,3 @@
-import numpy as np
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
@@ -6,35 +5,86 @@ import torch.optim as optim
 import pytorch_lightning as pl
 from tqdm import tqdm
 
+_LOG2_E = 1.4426950408889634  # log2(e), converts nats to bits
+
 
 class MaskedConvolution(nn.Module):
     def __init__(self, c_in, c_out, mask, **kwargs):
         """
-        Masked convolution layer for PixelCNN
+        Masked convolution layer for PixelCNN. The kernel is cropped to the rows and columns of the mask that
+        contain unmasked weights, so no compute is spent on weights that are always zero. The cropped mask is only
+        applied if it still contains zeros.
         :param c_in: number of input channels
         :param c_out: number of output channels
         :param mask: tensor of shape [kernel_size_H, kernel_size_W] with 0s where the weights should be masked
         :param kwargs: additional arguments for the convolution layer
         """
         super().__init__()
-        kernel_size = (mask.shape[0], mask.shape[1])
         dilation = 1 if "dilation" not in kwargs else kwargs["dilation"]
-        padding = tuple([dilation*(kernel_size[i] - 1)//2 for i in range(2)])  # assuming the stride is 1
-        self.conv = nn.Conv2d(c_in, c_out, kernel_size=kernel_size, padding=padding, **kwargs)
-
-        self.register_buffer('mask', mask[None, None])  # not updated during training but still part of model parameters
-        # and are included when saving and loading the model state
+        center = [(mask.shape[i] - 1)//2 for i in range(2)]
+        rows = mask.any(dim=1).nonzero().squeeze(dim=-1)
+        cols = mask.any(dim=0).nonzero().squeeze(dim=-1)
+        top, bottom, left, right = rows[0].item(), rows[-1].item(), cols[0].item(), cols[-1].item()
+        self.full_kernel_size = tuple(mask.shape)
+        self.crop = (slice(top, bottom+1), slice(left, right+1))
+        mask = mask[self.crop]
+        # Asymmetric padding (left, right, top, bottom) that keeps the output aligned with the same-padded
+        # convolution of the full kernel. Negative values crop the input, see _pad. Assuming the stride is 1.
+        self.padding = (dilation*(center[1] - left), dilation*(right - center[1]),
+                        dilation*(center[0] - top), dilation*(bottom - center[0]))
+        self.conv = nn.Conv2d(c_in, c_out, kernel_size=tuple(mask.shape), **kwargs)
+
+        if mask.all():
+            self.register_buffer('mask', None)
+        else:
+            self.register_buffer('mask', mask[None, None])  # not updated during training but still part of model
+            # parameters and are included when saving and loading the model state
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        """
+        Accept state dicts saved with the full, uncropped kernel and mask. The cropped rows and columns are always
+        masked, so dropping them does not change the layer.
+        """
+        weight = state_dict.get(prefix + 'conv.weight')
+        if weight is not None and tuple(weight.shape[2:]) == self.full_kernel_size:
+            state_dict[prefix + 'conv.weight'] = weight[(..., *self.crop)]
+        mask = state_dict.get(prefix + 'mask')
+        if mask is not None and tuple(mask.shape[2:]) == self.full_kernel_size:
+            if self.mask is None:
+                del state_dict[prefix + 'mask']
+            else:
+                state_dict[prefix + 'mask'] = mask[(..., *self.crop)]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _pad(self, x):
+        """
+        Apply self.padding. The input is padded before cropping, as F.pad fails if a crop is larger than the input.
+        """
+        left, right, top, bottom = self.padding
+        x = F.pad(x, (max(left, 0), max(right, 0), max(top, 0), max(bottom, 0)))
+        return x[:, :, max(-top, 0):x.shape[2] - max(-bottom, 0), max(-left, 0):x.shape[3] - max(-right, 0)]
 
-    def forward(self, x):
-        self.conv.weight.data *= self.mask  # the self.conv.weight.data is the kernel tensor
-        return self.conv(x)
+    def forward(self, x, weight=None, bias=None):
+        """
+        :param weight: optional kernel used instead of self.conv.weight, with the same shape apart from the number
+                       of output channels. It is masked like the own kernel.
+        :param bias: optional bias used instead of self.conv.bias
+        """
+        x = self._pad(x)
+        weight = self.conv.weight if weight is None else weight
+        bias = self.conv.bias if bias is None else bias
+        # Mask the kernel functionally instead of writing to the parameter, which keeps the forward pass free of
+        # side effects (and capturable by torch.compile / CUDA graphs). The masked weights get zero gradients.
+        if self.mask is not None:
+            weight = weight * self.mask
+        return F.conv2d(x, weight, bias, stride=self.conv.stride, dilation=self.conv.dilation,
+                        groups=self.conv.groups)
 
 
 class VerticalStackConvolution(MaskedConvolution):
 
     def __init__(self, c_in, c_out, kernel_size=3, mask_center=False, **kwargs):
-        # Mask out all pixels below. For efficiency, we could also reduce the kernel
-        # size in height, but for simplicity, we stick with masking here.
+        # Mask out all pixels below. The masked rows are cropped from the kernel by MaskedConvolution.
         mask = torch.ones(kernel_size, kernel_size)
         mask[kernel_size//2+1:,:] = 0
 
@@ -43,6 +93,8 @@ class VerticalStackConvolution(MaskedConvolution):
             mask[kernel_size//2,:] = 0
 
         super().__init__(c_in, c_out, mask, **kwargs)
+        # Number of rows above the current one that the convolution looks at
+        self.receptive_field = kwargs.get("dilation", 1) * (kernel_size//2)
 
 
 class HorizontalStackConvolution(MaskedConvolution):
@@ -60,6 +112,14 @@ class HorizontalStackConvolution(MaskedConvolution):
         super().__init__(c_in, c_out, mask, **kwargs)
 
 
+def gated_activation(x):
+    """
+    Gated activation tanh(a) * sigmoid(b), where a and b are the two halves of x along the channel dimension
+    """
+    val, gate = x.chunk(2, dim=1)
+    return torch.tanh(val) * torch.sigmoid(gate)
+
+
 class GatedMaskedConv(nn.Module):
 
     def __init__(self, c_in, **kwargs):
@@ -72,17 +132,40 @@ class GatedMaskedConv(nn.Module):
         self.conv_vert_to_horiz = nn.Conv2d(2*c_in, 2*c_in, kernel_size=1, padding=0)
         self.conv_horiz_1x1 = nn.Conv2d(c_in, c_in, kernel_size=1, padding=0)
 
-    def forward(self, v_stack, h_stack):
+    def _vertical_features(self, v_stack):
+        """
+        Return conv_vert(v_stack) and conv_vert_to_horiz(conv_vert(v_stack)). Both maps are linear, so the 1x1
+        convolution is applied to the kernel instead of the feature map and both are computed by one convolution
+        with 4*c_in output channels.
+        """
+        weight, bias = self.conv_vert.conv.weight, self.conv_vert.conv.bias
+        weight_1x1, bias_1x1 = self.conv_vert_to_horiz.weight[:, :, 0, 0], self.conv_vert_to_horiz.bias
+        fused_weight = torch.cat([weight, torch.einsum('oi,ichw->ochw', weight_1x1, weight)], dim=0)
+        fused_bias = torch.cat([bias, weight_1x1 @ bias + bias_1x1], dim=0)
+        return self.conv_vert(v_stack, weight=fused_weight, bias=fused_bias).chunk(2, dim=1)
+
+    def forward(self, v_stack, h_stack, cache=None):
+        """
+        :param v_stack: vertical stack input, ignored if the cache already holds the vertical stack features
+        :param h_stack: horizontal stack input, if None only the vertical stack is computed
+        :param cache: optional dict used during sampling. The vertical features passed to the horizontal stack are
+                      stored in it, or reused from it if already present.
+        """
         # Vertical stack (left)
-        v_stack_feat = self.conv_vert(v_stack)
-        v_val, v_gate = v_stack_feat.chunk(2, dim=1)
-        v_stack_out = torch.tanh(v_val) * torch.sigmoid(v_gate)
+        if cache is not None and "v_to_h_feat" in cache:
+            v_to_h_feat, v_stack_out = cache["v_to_h_feat"], None
+        else:
+            v_stack_feat, v_to_h_feat = self._vertical_features(v_stack)
+            v_stack_out = gated_activation(v_stack_feat)
+            if cache is not None:
+                cache["v_to_h_feat"] = v_to_h_feat
+        if h_stack is None:
+            return v_stack_out, None
 
         # Horizontal stack (right)
         h_stack_feat = self.conv_horiz(h_stack)
-        h_stack_feat = h_stack_feat + self.conv_vert_to_horiz(v_stack_feat)
-        h_val, h_gate = h_stack_feat.chunk(2, dim=1)
-        h_stack_feat = torch.tanh(h_val) * torch.sigmoid(h_gate)
+        h_stack_feat = h_stack_feat + v_to_h_feat
+        h_stack_feat = gated_activation(h_stack_feat)
         h_stack_out = self.conv_horiz_1x1(h_stack_feat)
         h_stack_out = h_stack_out + h_stack
 
@@ -91,7 +174,13 @@ class GatedMaskedConv(nn.Module):
 
 class PixelCNN(pl.LightningModule):
 
-    def __init__(self, c_in, c_hidden):
+    def __init__(self, c_in, c_hidden, compile_model=False):
+        """
+        :param c_in: number of image channels
+        :param c_hidden: number of hidden channels of the gated convolutions
+        :param compile_model: if True, compile the forward pass with torch.compile so that the elementwise gated
+                              activations are fused into single kernels. Sampling is not compiled.
+        """
         super().__init__()
         self.save_hyperparameters()
 
@@ -108,11 +197,18 @@ class PixelCNN(pl.LightningModule):
             GatedMaskedConv(c_hidden, dilation=2),
             GatedMaskedConv(c_hidden)
         ])
+        # Number of rows above a pixel that can influence its prediction
+        self.receptive_field = self.conv_vstack.receptive_field + sum(layer.conv_vert.receptive_field
+                                                                      for layer in self.conv_layers)
         # Output classification convolution (1x1)
         self.conv_out = nn.Conv2d(c_hidden, c_in * 256, kernel_size=1, padding=0)
 
         #self.example_input_array = train_set[0][0][None]
 
+        if compile_model:
+            # Compile in place (the parameter names stay the same). Only calls of the module itself are compiled
+            self.compile(dynamic=False)
+
     def forward(self, x):
         """
         Forward image through model and return logits for each pixel.
@@ -136,14 +232,45 @@ class PixelCNN(pl.LightningModule):
         out = out.reshape(out.shape[0], 256, out.shape[1]//256, out.shape[2], out.shape[3])
         return out
 
+    def _cache_vertical_stack(self, x):
+        """
+        Run the vertical stack over the rows above the row to sample and cache the vertical features of that row
+        for every gated layer. They only depend on the pixels above, so they stay valid while the row is filled.
+        Inputs:
+            x - Image tensor whose last row is the row to sample.
+        """
+        x = (x.float() / 255.0) * 2 - 1
+        v_stack = self.conv_vstack(x)
+        caches = []
+        for layer in self.conv_layers:
+            cache = {}
+            v_stack, _ = layer(v_stack, None, cache=cache)
+            caches.append({key: feat[:, :, -1:] for key, feat in cache.items()})
+        return caches
+
+    def _forward_row(self, x, caches):
+        """
+        Return the logits of a single row, computing only the horizontal stack on top of the cached vertical one.
+        Inputs:
+            x - Image tensor of shape [B, C, 1, W] holding the row to sample.
+            caches - Output of _cache_vertical_stack for this row.
+        """
+        x = (x.float() / 255.0) * 2 - 1
+        h_stack = self.conv_hstack(x)
+        for layer, cache in zip(self.conv_layers, caches):
+            _, h_stack = layer(None, h_stack, cache=cache)
+        out = self.conv_out(F.elu(h_stack))
+        out = out.reshape(out.shape[0], 256, out.shape[1]//256, out.shape[2], out.shape[3])
+        return out
+
     def calc_likelihood(self, x):
         # Forward pass with bpd likelihood calculation
-        pred = self.forward(x)
+        pred = self(x)
         nll = F.cross_entropy(pred, x, reduction='none')
-        bpd = nll.mean(dim=[1,2,3]) * np.log2(np.exp(1))
+        bpd = nll.mean(dim=[1,2,3]) * _LOG2_E
         return bpd.mean()
 
-    @torch.no_grad()
+    @torch.inference_mode()  # cheaper than no_grad for the many small ops of the sampling loop
     def sample(self, img_shape, device, img=None):
         """
         Sampling function for the autoregressive model.
@@ -156,18 +283,26 @@ class PixelCNN(pl.LightningModule):
         # Create empty image
         if img is None:
             img = torch.zeros(img_shape, dtype=torch.long).to(device) - 1
+        # Pixels to fill (-1), and on the host the positions where any image has a pixel to fill. Precomputing them
+        # avoids synchronizing with the device for every pixel.
+        to_fill = img == -1
+        pixels_to_fill = to_fill.any(dim=1).any(dim=0).cpu()
         # Generation loop
         for h in tqdm(range(img_shape[2]), leave=False):
+            if not pixels_to_fill[h].any():
+                continue
+            # For efficiency, we only input the rows within the receptive field above the current row.
+            # The vertical stack is computed once per row, only the horizontal stack is recomputed per pixel.
+            caches = self._cache_vertical_stack(img[:,:,max(0, h-self.receptive_field):h+1,:])
             for w in range(img_shape[3]):
-                for c in range(img_shape[1]):
-                    # Skip if not to be filled (-1)
-                    if (img[:,c,h,w] != -1).all().item():
-                        continue
-                    # For efficiency, we only have to input the upper part of the image
-                    # as all other parts will be skipped by the masked convolutions anyways
-                    pred = self.forward(img[:,:,:h+1,:])
-                    probs = F.softmax(pred[:,:,c,h,w], dim=-1)
-                    img[:,c,h,w] = torch.multinomial(probs, num_samples=1).squeeze(dim=-1)
+                if not pixels_to_fill[h, w]:
+                    continue
+                # The center pixel is masked for all channels, so the channels of a pixel only depend on the
+                # previous pixels and are sampled together from the same prediction
+                pred = self._forward_row(img[:,:,h:h+1,:], caches)
+                probs = F.softmax(pred[:,:,:,0,w], dim=1).transpose(1, 2).reshape(-1, 256)
+                new_pixels = torch.multinomial(probs, num_samples=1).reshape(img_shape[0], img_shape[1])
+                img[:,:,h,w] = torch.where(to_fill[:,:,h,w], new_pixels, img[:,:,h,w])
         return img
 
     def configure_optimizers(self):
@@ -1,6 +1,7 @@
 import unittest
 import torch
-from autoregressive.pixelCNN import PixelCNN
+import torch.nn.functional as F
+from autoregressive.pixelCNN import GatedMaskedConv, MaskedConvolution, PixelCNN, gated_activation
 
 
 class TestPixelCNN(unittest.TestCase):
@@ -21,6 +22,58 @@ class TestPixelCNN(unittest.TestCase):
         loss = self.model.calc_likelihood(input_img)
         self.assertIsInstance(loss, torch.Tensor)
 
+    def test_masked_conv_matches_full_kernel(self):
+        # Mask of the first PixelCNN layer without stacks: rows above and pixels on the left
+        mask = torch.ones(3, 3)
+        mask[2, :] = 0
+        mask[1, 1:] = 0
+        x = torch.randn(2, 2, 9, 10)
+        for dilation in [1, 2, 4]:
+            conv = MaskedConvolution(2, 4, mask, dilation=dilation)
+            self.assertEqual(conv.conv.weight.shape[2:], (2, 3))
+            full_weight = torch.zeros(4, 2, 3, 3)
+            full_weight[:, :, :2] = conv.conv.weight * conv.mask
+            expected = F.conv2d(x, full_weight, conv.conv.bias, padding=dilation, dilation=dilation)
+            self.assertTrue(torch.allclose(conv(x), expected, atol=1e-5))
+
+        conv(x).sum().backward()
+        self.assertTrue(torch.all(conv.conv.weight.grad[conv.mask.expand_as(conv.conv.weight) == 0] == 0))
+
+    def test_masked_conv_loads_full_kernel_state_dict(self):
+        # State dicts with the full 3x3 kernel and mask, as saved before the kernel was cropped, still load
+        mask = torch.ones(3, 3)
+        mask[2, :] = 0
+        conv = MaskedConvolution(2, 4, mask)
+        full_weight = torch.zeros(4, 2, 3, 3)
+        full_weight[:, :, :2] = torch.randn(4, 2, 2, 3)
+        bias = torch.randn(4)
+        conv.load_state_dict({'conv.weight': full_weight, 'conv.bias': bias, 'mask': mask[None, None]})
+        x = torch.randn(2, 2, 9, 10)
+        self.assertTrue(torch.allclose(conv(x), F.conv2d(x, full_weight, bias, padding=1), atol=1e-5))
+
+    def test_gated_conv_fused_vertical_features(self):
+        # The fused vertical convolution equals conv_vert followed by conv_vert_to_horiz
+        layer = GatedMaskedConv(4, dilation=2)
+        v_stack, h_stack = torch.randn(2, 4, 9, 10), torch.randn(2, 4, 9, 10)
+        with torch.no_grad():
+            v_stack_feat = layer.conv_vert(v_stack)
+            h_stack_feat = layer.conv_horiz(h_stack) + layer.conv_vert_to_horiz(v_stack_feat)
+            expected_v = gated_activation(v_stack_feat)
+            expected_h = layer.conv_horiz_1x1(gated_activation(h_stack_feat)) + h_stack
+            v_stack_out, h_stack_out = layer(v_stack, h_stack)
+        self.assertTrue(torch.allclose(v_stack_out, expected_v, atol=1e-5))
+        self.assertTrue(torch.allclose(h_stack_out, expected_h, atol=1e-5))
+
+    def test_sample_cache_matches_forward(self):
+        input_img = torch.randint(0, 256, self.img_shape, dtype=torch.long)
+        receptive_field = self.model.receptive_field
+        with torch.no_grad():
+            pred = self.model(input_img)
+            for h in [0, 5, self.img_shape[2] - 1]:
+                caches = self.model._cache_vertical_stack(input_img[:, :, max(0, h - receptive_field):h + 1, :])
+                row_pred = self.model._forward_row(input_img[:, :, h:h + 1, :], caches)
+                self.assertTrue(torch.allclose(row_pred[:, :, :, 0], pred[:, :, :, h], atol=1e-4))
+
     def test_sample(self):
         # Test sampling function
         with torch.no_grad():
@@ -23,6 +23,8 @@ if __name__ == "__main__":
     # set device
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
+    # bfloat16 mixed precision on GPUs that support it: tensor core throughput without loss scaling
+    precision = "bf16-mixed" if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else "32-true"
 
     # download dataset
     DATASET_PATH = "../data/"
@@ -46,6 +48,7 @@ if __name__ == "__main__":
     trainer = pl.Trainer(default_root_dir=os.path.join(CHECKPOINT_PATH, "PixelCNN"),
                          accelerator="gpu" if str(device).startswith("cuda") else "cpu",
                          devices=1,
+                         precision=precision,
                          max_epochs=2,
                          callbacks=[ModelCheckpoint(save_weights_only=True, mode="min", monitor="val_bpd"),
                                     LearningRateMonitor("epoch")])
@@ -1,5 +1,7 @@
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint as cp
+from torch.nn.utils import fuse_conv_bn_eval
 from types import SimpleNamespace
 from cv_net.util.util import act_fn_by_name
 
@@ -27,17 +29,30 @@ class DenseLayer(nn.Module):
         out = torch.cat([out, x], dim=1)
         return out
 
+    def fuse(self):
+        """
+        Fold the batch norm following the 1x1 convolution into that convolution. Only valid in eval mode.
+        """
+        if isinstance(self.net[3], nn.BatchNorm2d):
+            self.net[2] = fuse_conv_bn_eval(self.net[2], self.net[3])
+            self.net[3] = nn.Identity()
+        return self
+
 
 class DenseBlock(nn.Module):
-    def __init__(self, c_in, num_layers, bn_size, growth_rate, act_fn):
+    def __init__(self, c_in, num_layers, bn_size, growth_rate, act_fn, memory_efficient=False):
         """
         :param c_in: number of input channels
         :param num_layers: Number of dense layers to apply in the block
         :param bn_size: Bottleneck size to use in the dense layers
         :param growth_rate: Growth rate to use in the dense layers
         :param act_fn: Activation function to use in the dense layers
+        :param memory_efficient: If True, checkpoint the dense layers to recompute their activations in the backward
+        pass instead of storing them. Slower, but allows much larger batch sizes.
         """
         super().__init__()
+        self.growth_rate = growth_rate
+        self.memory_efficient = memory_efficient
         layers = []
         for layer_idx in range(num_layers):
             layers.append(
@@ -46,12 +61,36 @@ class DenseBlock(nn.Module):
                            growth_rate=growth_rate,
                            act_fn=act_fn)
             )
-        self.block = nn.Sequential(*layers)
+        self.block = nn.ModuleList(layers)
 
-    def forward(self, x):
-        out = self.block(x)
+    def _forward_preallocated(self, x):
+        """
+        Inference without torch.cat. Each layer puts its new features in front of its input, so the block input is
+        written to the end of one preallocated output tensor and every layer fills the channels in front of its
+        input. Can't be used for training, as autograd doesn't allow writing into tensors saved for the backward pass.
+        """
+        B, c_in, H, W = x.shape
+        c_out = c_in + len(self.block) * self.growth_rate
+        memory_format = torch.channels_last if x.is_contiguous(memory_format=torch.channels_last) \
+            else torch.contiguous_format
+        out = torch.empty((B, c_out, H, W), dtype=x.dtype, device=x.device, memory_format=memory_format)
+        start = c_out - c_in
+        out[:, start:] = x
+        for layer in self.block:
+            out[:, start - self.growth_rate:start] = layer.net(out[:, start:])
+            start -= self.growth_rate
         return out
 
+    def forward(self, x):
+        if not torch.is_grad_enabled():
+            return self._forward_preallocated(x)
+        for layer in self.block:
+            if self.memory_efficient:
+                x = cp.checkpoint(layer, x, use_reentrant=False)
+            else:
+                x = layer(x)
+        return x
+
 
 class TransitionLayer(nn.Module):
     def __init__(self, c_in, c_out, act_fn):
@@ -68,16 +107,25 @@ class TransitionLayer(nn.Module):
 
 
 class DenseNet(nn.Module):
-    def __init__(self, num_classes=10, num_layers=[6,6,6,6], bn_size=2, growth_rate=16, act_fn_name="relu", **kwargs):
+    def __init__(self, num_classes=10, num_layers=[6,6,6,6], bn_size=2, growth_rate=16, act_fn_name="relu",
+                 memory_efficient=False, compile_model=False, **kwargs):
         super().__init__()
         self.hparams = SimpleNamespace(num_classes=num_classes,
                                        num_layers=num_layers,
                                        bn_size=bn_size,
                                        growth_rate=growth_rate,
                                        act_fn_name=act_fn_name,
-                                       act_fn=act_fn_by_name[act_fn_name])
+                                       act_fn=act_fn_by_name[act_fn_name],
+                                       memory_efficient=memory_efficient,
+                                       compile_model=compile_model)
         self._create_network()
         self._init_params()
+        # Channels last (NHWC) lets cuDNN pick its faster tensor core kernels for the conv and batch norm stacks
+        self.to(memory_format=torch.channels_last)
+        if self.hparams.compile_model:
+            # Compile the static conv stack in place (the parameter names stay the same). max-autotune benchmarks
+            # the convolution kernels and fuses the batch norms and activations
+            self.blocks.compile(mode="max-autotune", dynamic=False)
 
     def _create_network(self):
         c_hidden = self.hparams.growth_rate * self.hparams.bn_size # The start number of hidden channels
@@ -93,7 +141,8 @@ class DenseNet(nn.Module):
                            num_layers=num_layers,
                            bn_size=self.hparams.bn_size,
                            growth_rate=self.hparams.growth_rate,
-                           act_fn=self.hparams.act_fn)
+                           act_fn=self.hparams.act_fn,
+                           memory_efficient=self.hparams.memory_efficient)
             )
             c_hidden = c_hidden + num_layers * self.hparams.growth_rate # Overall output of the dense block
             if block_idx < len(self.hparams.num_layers)-1: # Don't apply transition layer on last block
@@ -121,7 +170,19 @@ class DenseNet(nn.Module):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
 
+    def fuse(self):
+        """
+        Switch to eval mode and fold the batch norms that follow a convolution into it for faster inference.
+        The other batch norms come before an activation and cannot be folded. The fused model should not be trained.
+        """
+        self.eval()
+        for m in self.modules():
+            if isinstance(m, DenseLayer):
+                m.fuse()
+        return self
+
     def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
         x = self.input_net(x)
         x = self.blocks(x)
         x = self.output_net(x)
@@ -33,6 +33,26 @@ class TestDenseNet(unittest.TestCase):
         y = densenet_block(x)
         self.assertEqual(y.shape, (1, 9, 2, 2))
         self.assertEqual(torch.any(torch.isnan(y)), False)
+        # Without gradients, the layers write into a preallocated output instead of concatenating
+        with torch.no_grad():
+            y_preallocated = densenet_block(x)
+        self.assertTrue(torch.allclose(y, y_preallocated, atol=1e-6))
+
+    def test_memory_efficient_dense_block(self):
+        set_seed(100)
+        densenet_block = DenseBlock(c_in=3, num_layers=2, bn_size=2, growth_rate=3, act_fn=torch.nn.ReLU)
+        checkpointed_block = DenseBlock(c_in=3, num_layers=2, bn_size=2, growth_rate=3, act_fn=torch.nn.ReLU,
+                                        memory_efficient=True)
+        checkpointed_block.load_state_dict(densenet_block.state_dict())
+        x = torch.randn(2, 3, 4, 4, requires_grad=True)
+        y = densenet_block(x)
+        y.sum().backward()
+        x_grad = x.grad.clone()
+        x.grad = None
+        y_checkpointed = checkpointed_block(x)
+        y_checkpointed.sum().backward()
+        self.assertTrue(torch.allclose(y, y_checkpointed, atol=1e-6))
+        self.assertTrue(torch.allclose(x_grad, x.grad, atol=1e-6))
 
     def test_dense_net(self):
         set_seed(100)
@@ -52,6 +72,19 @@ class TestDenseNet(unittest.TestCase):
         self.assertEqual(y.shape, (1, 10))
         self.assertEqual(torch.any(torch.isnan(y)), False)
 
+    def test_fuse(self):
+        set_seed(100)
+        densenet = DenseNet(num_classes=10, num_layers=[2, 2], bn_size=2, growth_rate=3, act_fn_name="relu")
+        # One training step so that the batch norm statistics are not the identity
+        densenet(torch.randn(4, 3, 32, 32))
+        densenet.eval()
+        x = torch.randn(2, 3, 32, 32)
+        with torch.no_grad():
+            y = densenet(x)
+            y_fused = densenet.fuse()(x)
+        self.assertTrue(torch.allclose(y, y_fused, atol=1e-5))
+        self.assertEqual(sum(isinstance(m, torch.nn.BatchNorm2d) for m in densenet.blocks[0].modules()), 2)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
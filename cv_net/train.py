@@ -97,6 +97,7 @@ def train_model(model_lookup_dict, model_name, save_name=None, pretrained_model_
                          accelerator="gpu" if str(device).startswith("cuda") else "cpu",
                          # We run on a GPU (if possible)
                          devices=1,  # How many GPUs/CPUs we want to use (1 is enough for the notebooks)
+                         precision=precision,  # bf16 mixed precision if supported, see __main__
                          max_epochs=3,  # How many epochs to train for if no patience is set
                          callbacks=[ModelCheckpoint(save_weights_only=True, mode="max", monitor="val_acc"),
                                     # Save the best checkpoint based on the maximum val_acc recorded. Saves only weights and not optimizer
@@ -135,6 +136,8 @@ if __name__ == "__main__":
     # set device
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
+    # bfloat16 mixed precision on GPUs that support it: tensor core throughput without loss scaling
+    precision = "bf16-mixed" if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else "32-true"
     # download dataset
     DATASET_PATH = "../data/"
     train_dataset = CIFAR10(root=DATASET_PATH, train=True, download=True)
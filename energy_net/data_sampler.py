@@ -1,47 +1,64 @@
 import torch
-import random
 import numpy as np
 
 
 class Sampler:
-    def __init__(self, model, img_shape, sample_size, max_len=8192):
+    def __init__(self, model, img_shape, sample_size, max_len=8192, refresh_interval=1):
         """
         :param model: Neural network model to use for modeling E_theta
         :param img_shape: shape of the images to model
         :param sample_size: batch size of the samples
         :param max_len: maximum number of data points to keep in the buffer
+        :param refresh_interval: number of MCMC steps the gradient of the model tail is reused for, see generate_samples
         """
         super().__init__()
         self.model = model
+        self.refresh_interval = refresh_interval
         self.img_shape = img_shape
         self.sample_size = sample_size
         self.max_len = max_len
-        # each sampled element shape is (1, img_shape), converted the sample values to 0~1
-        self.examples = [(torch.rand((1,)+img_shape)*2-1) for _ in range(self.sample_size)]
+        # The buffer is a single tensor used as a ring buffer, the oldest examples are overwritten first.
+        # It lives in pinned memory when a GPU is available so that batches are copied to it asynchronously.
+        pin_memory = torch.cuda.is_available()
+        self.examples = torch.empty((max_len,) + img_shape, pin_memory=pin_memory)
+        # start with sample_size random examples, with values between -1 and 1
+        self.examples[:sample_size].uniform_(-1, 1)
+        self.num_examples = sample_size
+        self.next_idx = sample_size % max_len
+        # pinned staging tensor the old examples are gathered into before the copy to the device
+        self.staging = torch.empty((sample_size,) + img_shape, pin_memory=pin_memory)
 
     def sample_new_examples(self, steps=60, step_size=10, device="cuda"):
         """
         Functions for getting a new batch of "fake" images
         :param steps: Number of iterations in the MCMC algorithm
         :param step_size: Learning rate for the MCMC using Langevin dynamics
+        :param device: Device of the model, the batch is copied to it from the buffer
         :return: New batch of images
         """
         # choose 95% of the batch from the buffer, 5% generate from scratch
         n_new = np.random.binomial(self.sample_size, 0.05)
-        rand_imgs = torch.rand((n_new,) + self.img_shape)*2-1
-        old_imgs = torch.cat(random.choices(self.examples, k=self.sample_size-n_new), dim=0)
-        inp_imgs = torch.cat([old_imgs, rand_imgs], dim=0).detach().to(device)
+        rand_imgs = torch.rand((n_new,) + self.img_shape, device=device)*2-1
+        idx = torch.randint(self.num_examples, (self.sample_size-n_new,))
+        old_imgs = torch.index_select(self.examples, 0, idx, out=self.staging[:len(idx)])
+        # The staging tensor is only reused in the next call, after the copy back to the CPU below has
+        # synchronized with the device
+        old_imgs = old_imgs.to(device, non_blocking=True)
+        inp_imgs = torch.cat([old_imgs, rand_imgs], dim=0).detach()
 
         # perform MCMC sampling
-        inp_imgs = Sampler.generate_samples(self.model, inp_imgs, steps=steps, step_size=step_size)
+        inp_imgs = Sampler.generate_samples(self.model, inp_imgs, steps=steps, step_size=step_size,
+                                            refresh_interval=self.refresh_interval)
 
-        # add new images to the buffer and remove old ones if necessary
-        self.examples = list(inp_imgs.to(torch.device("cpu")).chunk(self.sample_size, dim=0)) + self.examples
-        self.examples = self.examples[:self.max_len]
+        # add new images to the buffer, overwriting the oldest ones if necessary
+        idx = (self.next_idx + torch.arange(self.sample_size)) % self.max_len
+        self.examples[idx] = inp_imgs.to(torch.device("cpu"))
+        self.next_idx = (self.next_idx + self.sample_size) % self.max_len
+        self.num_examples = min(self.num_examples + self.sample_size, self.max_len)
         return inp_imgs
 
     @staticmethod
-    def generate_samples(model, inp_imgs, steps=60, step_size=10, return_img_per_step=False):
+    def generate_samples(model, inp_imgs, steps=60, step_size=10, return_img_per_step=False, refresh_interval=1):
         """
         Function for generating samples using Langevin dynamics
         :param model: Neural network model to use for modeling E_theta
@@ -49,6 +66,10 @@ class Sampler:
         :param steps: Number of iterations in the MCMC algorithm
         :param step_size: Learning rate for the MCMC using Langevin dynamics
         :param return_img_per_step: If True, return images at each step
+        :param refresh_interval: If larger than 1, the model must provide head and tail methods. The gradient of the
+        tail w.r.t. its input is only recomputed every refresh_interval steps and reused in between, as consecutive
+        samples are highly correlated. Only the head is evaluated and backpropagated in the other steps, which
+        approximates the gradient.
         :return: Images generated using Langevin dynamics
         """
         # before MCMC, set the model parameters to "required_grad=False"
@@ -71,20 +92,27 @@ class Sampler:
         imgs_per_step = []
 
         # Loop over the number of steps
-        for _ in range(steps):
+        for step in range(steps):
             # Add noise to the input images
             noise.normal_(0, 0.005)  # sample noise from a normal distribution in place
-            inp_imgs.data.add_(noise.data)  # calling add_ on the data attribute of the tensor does not affect gradient tracking
-            inp_imgs.data.clamp(min=-1.0, max=1.0)  # cap the values to -1~1
-            # Calculate gradients for the current input
-            out_imgs = -model(inp_imgs) # the model represents -E_theta
-            out_imgs.sum().backward()
-            inp_imgs.grad.data.clamp_(-0.03, 0.03) # For stability, we clip the gradients
-            # Apply gradients to current samples
-            inp_imgs.data.add_(-step_size * inp_imgs.grad.data)
-            inp_imgs.grad.detach_()  # gradient calculated in the current iteration does not affect subsequent iterations
-            inp_imgs.grad.zero_()  # avoid accumulating gradients from previous iterations due to line 84
-            inp_imgs.data.clamp_(-1.0, 1.0)
+            with torch.no_grad():  # in-place updates of the images are not tracked by autograd
+                inp_imgs.add_(noise).clamp_(min=-1.0, max=1.0)  # cap the values to -1~1
+            # Calculate gradients for the current input. autograd.grad returns them directly instead of
+            # accumulating them in inp_imgs.grad, so nothing has to be reset between the iterations
+            if refresh_interval == 1:
+                out_imgs = -model(inp_imgs)  # the model represents -E_theta
+                grad, = torch.autograd.grad(out_imgs.sum(), inp_imgs)
+            elif step % refresh_interval == 0:
+                # Full pass, also keep the gradient w.r.t. the output of the head
+                head_out = model.head(inp_imgs)
+                out_imgs = -model.tail(head_out)
+                grad, head_grad = torch.autograd.grad(out_imgs.sum(), [inp_imgs, head_out])
+            else:
+                head_out = model.head(inp_imgs)
+                grad, = torch.autograd.grad(head_out, inp_imgs, grad_outputs=head_grad)
+            # Apply the gradients to the current samples. For stability, we clip the gradients
+            with torch.no_grad():
+                inp_imgs.add_(grad.clamp_(-0.03, 0.03), alpha=-step_size).clamp_(min=-1.0, max=1.0)
 
             if return_img_per_step:
                 imgs_per_step.append(inp_imgs.detach().clone())
@@ -100,4 +128,4 @@ class Sampler:
         if return_img_per_step:
             return torch.stack(imgs_per_step, dim=0)
         else:
-            return inp_imgs
+            return inp_imgs.detach()
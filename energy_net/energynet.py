@@ -5,13 +5,12 @@ import pytorch_lightning as pl
 from energy_net.data_sampler import Sampler
 
 
-class Swish(nn.Module):
-    def forward(self, x):
-        return x * torch.sigmoid(x)
+# Swish, x * sigmoid(x). nn.SiLU computes it in a single fused kernel
+Swish = nn.SiLU
 
 
 class CNNModel(nn.Module):
-    def __init__(self, hidden_features=32, out_dim=1, **kwargs):
+    def __init__(self, hidden_features=32, out_dim=1, compile_model=False, **kwargs):
         super(CNNModel, self).__init__()
         c_hid1 = hidden_features // 2
         c_hid2 = hidden_features
@@ -31,17 +30,41 @@ class CNNModel(nn.Module):
             Swish(),
             nn.Linear(c_hid3, out_dim)
         )
+        # Number of layers of the head, the first two conv-Swish blocks. See Sampler.generate_samples
+        self.num_head_layers = 4
+        # Channels last (NHWC) lets cuDNN pick its faster tensor core kernels for the conv stack
+        self.to(memory_format=torch.channels_last)
+        if compile_model:
+            # Compile the conv tower in place (the parameter names stay the same) with kernel autotuning.
+            # head and tail, used by the sampler, run the layers uncompiled
+            self.cnn_layers.compile(mode="max-autotune", dynamic=False)
 
     def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
         return self.cnn_layers(x).squeeze(dim=-1)
 
+    def head(self, x):
+        """
+        First layers of the model, forward(x) is equal to tail(head(x))
+        """
+        x = x.contiguous(memory_format=torch.channels_last)
+        for layer in self.cnn_layers[:self.num_head_layers]:
+            x = layer(x)
+        return x
+
+    def tail(self, h):
+        for layer in self.cnn_layers[self.num_head_layers:]:
+            h = layer(h)
+        return h.squeeze(dim=-1)
+
 
 class DeepEnergyModel(pl.LightningModule):
-    def __init__(self, img_shape, batch_size, alpha=0.1, lr=1e-4, beta1=0.0, **cnn_args):
+    def __init__(self, img_shape, batch_size, alpha=0.1, lr=1e-4, beta1=0.0, refresh_interval=1, **cnn_args):
         super().__init__()
         self.save_hyperparameters()
         self.model = CNNModel(**cnn_args)  # the cnn model denotes -E_theta
-        self.sampler = Sampler(self.model, img_shape, batch_size)
+        # refresh_interval > 1 reuses the gradient of the model tail across MCMC steps, see Sampler.generate_samples
+        self.sampler = Sampler(self.model, img_shape, batch_size, refresh_interval=refresh_interval)
         self.example_input_array = torch.zeros(1, *img_shape)
 
     def forward(self, x):
@@ -54,12 +77,17 @@ class DeepEnergyModel(pl.LightningModule):
         scheduler = optim.lr_scheduler.StepLR(optimizer, 1, gamma=0.97)  # Exponential decay over epochs
         return [optimizer], [scheduler]
 
-    def training_step(self, batch, batch_idx, device="cpu"):
+    def training_step(self, batch, batch_idx):
         real_imgs, _ = batch
         small_noise = torch.randn_like(real_imgs) * 0.005
-        real_imgs.add_(small_noise).clamp_(min=-1.0, max=1.0)
-
-        fake_imgs = self.sampler.sample_new_examples(steps=60, step_size=10, device=device)
+        # Not in place, the batch tensor may be shared with the data loader. Clamping the new tensor in place
+        # avoids allocating another one.
+        real_imgs = (real_imgs + small_noise).clamp_(min=-1.0, max=1.0)
+
+        # Keep the Langevin dynamics in full precision when training with mixed precision, the small gradient
+        # steps on the images are sensitive to rounding
+        with torch.autocast(device_type=real_imgs.device.type, enabled=False):
+            fake_imgs = self.sampler.sample_new_examples(steps=60, step_size=10, device=self.device)
 
         # predict energy score for all images
         imp_imgs = torch.cat([real_imgs, fake_imgs], dim=0)
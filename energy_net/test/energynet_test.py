@@ -2,6 +2,7 @@ import unittest
 import torch
 from torchsummary import summary
 from energy_net.energynet import CNNModel
+from energy_net.data_sampler import Sampler
 
 
 class TestEnergyNet(unittest.TestCase):
@@ -15,6 +16,44 @@ class TestEnergyNet(unittest.TestCase):
 
         self.assertEqual(torch.any(torch.isnan(y)), False)
 
+    def test_refresh_interval(self):
+        cnn = CNNModel(hidden_features=32, out_dim=1)
+        x = torch.rand(4, 1, 28, 28) * 2 - 1
+        self.assertTrue(torch.allclose(cnn.tail(cnn.head(x)), cnn(x), atol=1e-6))
+        # With a single step, the first step is always a full pass and both sampling variants are equal
+        torch.manual_seed(0)
+        exact = Sampler.generate_samples(cnn, x.clone(), steps=1)
+        torch.manual_seed(0)
+        cached = Sampler.generate_samples(cnn, x.clone(), steps=1, refresh_interval=3)
+        self.assertTrue(torch.allclose(exact, cached, atol=1e-6))
+        samples = Sampler.generate_samples(cnn, x.clone(), steps=7, refresh_interval=3)
+        self.assertEqual(samples.shape, x.shape)
+        self.assertEqual(torch.any(torch.isnan(samples)), False)
+
+        # The second step reuses the gradient w.r.t. the head output of the first step. Reproduce both steps by hand.
+        # The gradients of the untrained model are small, a large step size makes the first step move the images
+        step_size = 1000
+        torch.manual_seed(0)
+        cached = Sampler.generate_samples(cnn, x.clone(), steps=2, step_size=step_size, refresh_interval=2)
+        torch.manual_seed(0)
+        noise = torch.randn(x.shape)
+        imgs = x.clone()
+        head_grad = None
+        for step in range(2):
+            noise.normal_(0, 0.005)
+            imgs = (imgs + noise).clamp(min=-1.0, max=1.0).requires_grad_()
+            head_out = cnn.head(imgs)
+            if step == 0:
+                head_out_leaf = head_out.detach().requires_grad_()
+                head_grad, = torch.autograd.grad(-cnn.tail(head_out_leaf).sum(), head_out_leaf)
+            grad, = torch.autograd.grad(head_out, imgs, grad_outputs=head_grad)
+            imgs = (imgs.detach() - step_size * grad.clamp(-0.03, 0.03)).clamp(min=-1.0, max=1.0)
+        self.assertTrue(torch.allclose(cached, imgs, atol=1e-6))
+        # The cached gradient differs from the exact one in the second step
+        torch.manual_seed(0)
+        exact = Sampler.generate_samples(cnn, x.clone(), steps=2, step_size=step_size)
+        self.assertFalse(torch.allclose(exact, cached, atol=1e-6))
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -1,4 +1,3 @@
-import random
 import os
 import matplotlib.pyplot as plt
 # PyTorch
@@ -55,7 +54,8 @@ class SamplerCallback(pl.Callback):
 
     def on_epoch_end(self, trainer, pl_module):
         if trainer.current_epoch % self.every_n_epochs == 0:
-            exmp_imgs = torch.cat(random.choices(pl_module.sampler.examples, k=self.num_imgs), dim=0)
+            sampler = pl_module.sampler
+            exmp_imgs = sampler.examples[torch.randint(sampler.num_examples, (self.num_imgs,))]
             grid = torchvision.utils.make_grid(exmp_imgs, nrow=4, normalize=True, range=(-1,1))
             trainer.logger.experiment.add_image("sampler", grid, global_step=trainer.current_epoch)
 
@@ -86,6 +86,8 @@ if __name__ == "__main__":
     # set device
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
+    # bfloat16 mixed precision on GPUs that support it: tensor core throughput without loss scaling
+    precision = "bf16-mixed" if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else "32-true"
 
     # download dataset
     DATASET_PATH = "../data/"
@@ -111,6 +113,7 @@ if __name__ == "__main__":
     trainer = pl.Trainer(default_root_dir=os.path.join(CHECKPOINT_PATH, "MNIST"),
                          accelerator="gpu" if str(device).startswith("cuda") else "cpu",
                          devices=1,
+                         precision=precision,
                          max_epochs=10,
                          gradient_clip_val=0.1,
                          callbacks=[